@@ -17,6 +17,7 @@ PACKAGE_NAME = 'SublimeTmpl'
 TMLP_DIR = 'templates'
 KEY_SYNTAX = 'syntax'
 KEY_FILE_EXT = 'extension'
+PROJECT_VARIABLES = frozenset(['project_base_name', 'project_path', 'platform'])
 
 # st3: Installed Packages/xx.sublime-package
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
@@ -29,6 +30,14 @@ PACKAGES_PATH = sublime.packages_path()  # for ST2
 IS_GTE_ST3 = int(sublime.version()[0]) >= 3
 DISABLE_KEYMAP = None
 
+# compiled once, used on every template / key context query
+ESCAPE_DOLLAR_RE = re.compile(r"(?<!\\)\${(?!\d)")
+KEYMAP_SPLIT_RE = re.compile(r'\s*,\s*')
+PLACEHOLDER_RE = re.compile(r'\$\{([^{}]+)\}')
+
+# parsed settings, cleared by the settings on_change hook
+SETTINGS_CACHE = {}
+
 class SublimeTmplCommand(sublime_plugin.TextCommand):
 
     def run(self, edit, type='html', paths = [None]):
@@ -108,27 +117,53 @@ class SublimeTmplCommand(sublime_plugin.TextCommand):
     def format_tag(self, code):
         win = self.view.window()
         code = code.replace('\r', '') # replace \r\n -> \n
-        # format
-        settings = self.get_settings()
-        format = settings.get('date_format', '%Y-%m-%d')
-        date = datetime.datetime.now().strftime(format)
         if not IS_GTE_ST3:
             code = code.decode('utf8') # for st2 && Chinese characters
-        code = code.replace('${date}', date)
+
+        # static template: nothing to replace or escape
+        if '${' not in code:
+            return code
+
+        # only the variables the template references
+        used = set(PLACEHOLDER_RE.findall(code))
+        settings = self.get_settings()
 
         attr = settings.get('attr', {})
-        for key in attr:
-            code = code.replace('${%s}' % key, attr.get(key, ''))
+        attr_values = dict((key, attr.get(key, '')) for key in used if key in attr)
+
+        # attr values may reference project variables too
+        project_keys = set(used)
+        for value in attr_values.values():
+            project_keys.update(PLACEHOLDER_RE.findall(value))
+        project_keys &= PROJECT_VARIABLES
 
+        # key -> value, later entries win (date > attr > project)
+        table = {}
         # print(hasattr(win, 'extract_variables'))
         # print(win.extract_variables(), win.project_data())
-        if settings.get('enable_project_variables', False) and hasattr(win, 'extract_variables'):
+        if project_keys and settings.get('enable_project_variables', False) and hasattr(win, 'extract_variables'):
             variables = win.extract_variables()
-            for key in ['project_base_name', 'project_path', 'platform']:
-                code = code.replace('${%s}' % key, variables.get(key, ''))
+            for key in project_keys:
+                table[key] = variables.get(key, '')
+
+            # project variables are expanded after attr, as before
+            for key in attr_values:
+                attr_values[key] = PLACEHOLDER_RE.sub(
+                    lambda m: table.get(m.group(1), m.group(0)), attr_values[key])
+
+        table.update(attr_values)
+
+        if 'date' in used:
+            # format
+            format = settings.get('date_format', '%Y-%m-%d')
+            table['date'] = datetime.datetime.now().strftime(format)
+
+        # replace all variables in one pass, unknown ones are left as is
+        if table:
+            code = PLACEHOLDER_RE.sub(lambda m: table.get(m.group(1), m.group(0)), code)
 
         # keep ${var..}
-        code = re.sub(r"(?<!\\)\${(?!\d)", '\${', code)
+        code = ESCAPE_DOLLAR_RE.sub(r'\\${', code)
         return code
 
     def creat_tab(self, view, paths = [None]):
@@ -166,12 +201,21 @@ class SublimeTmplReplaceCommand(sublime_plugin.TextCommand):
         s = s.replace(old, new)
         self.view.replace(edit, region, s)
 
+def get_disable_keymap_actions():
+    # '', 'all', True, or the set of disabled action names
+    if 'disable_keymap_actions' not in SETTINGS_CACHE:
+        settings = sublime.load_settings(PACKAGE_NAME + '.sublime-settings')
+        actions = settings.get('disable_keymap_actions', '')
+        if actions and actions != 'all' and actions != True:
+            actions = frozenset(KEYMAP_SPLIT_RE.split(actions.strip()))
+        SETTINGS_CACHE['disable_keymap_actions'] = actions
+    return SETTINGS_CACHE['disable_keymap_actions']
+
 class SublimeTmplEventListener(sublime_plugin.EventListener):
     def __init__(self):
         self.unsaved_ids = {}
     def on_query_context(self, view, key, operator, operand, match_all):
-        settings = sublime.load_settings(PACKAGE_NAME + '.sublime-settings')
-        disable_keymap_actions = settings.get('disable_keymap_actions', '')
+        disable_keymap_actions = get_disable_keymap_actions()
         # print ("key1: %s, %s" % (key, disable_keymap_actions))
         global DISABLE_KEYMAP
         DISABLE_KEYMAP = False;
@@ -183,7 +227,7 @@ class SublimeTmplEventListener(sublime_plugin.EventListener):
             DISABLE_KEYMAP = True;
             return False
         prefix, name = key.split('.')
-        ret = name not in re.split(r'\s*,\s*', disable_keymap_actions.strip())
+        ret = name not in disable_keymap_actions
         # print(name, ret)
         DISABLE_KEYMAP = True if not ret else False;
         return ret
@@ -206,6 +250,10 @@ class SublimeTmplEventListener(sublime_plugin.EventListener):
             del self.unsaved_ids[view.id()]
 
 def plugin_loaded():  # for ST3 >= 3016
+    # first, so a failing migration below can't leave SETTINGS_CACHE stale
+    settings = sublime.load_settings(PACKAGE_NAME + '.sublime-settings')
+    settings.add_on_change(PACKAGE_NAME, SETTINGS_CACHE.clear)
+
     # global PACKAGES_PATH
     PACKAGES_PATH = sublime.packages_path()
     TARGET_PATH = os.path.join(PACKAGES_PATH, PACKAGE_NAME)
@@ -263,6 +311,10 @@ def plugin_loaded():  # for ST3 >= 3016
             # print(file, '=>', os.path.join(custom_path, filename))
             os.rename(file, os.path.join(custom_path, filename))
 
+def plugin_unloaded():
+    settings = sublime.load_settings(PACKAGE_NAME + '.sublime-settings')
+    settings.clear_on_change(PACKAGE_NAME)
+
 if not IS_GTE_ST3:
     sublime.set_timeout(plugin_loaded, 0)
 